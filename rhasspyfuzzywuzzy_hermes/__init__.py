@@ -1,13 +1,18 @@
 """Hermes MQTT server for Rhasspy fuzzywuzzy"""
 import json
 import logging
+import pickle
+import re
 import sqlite3
+import time
 import typing
+from collections import OrderedDict
 from pathlib import Path
 
 import networkx as nx
-import rhasspyfuzzywuzzy
+import numpy as np
 import rhasspynlu
+from rapidfuzz import utils as rf_utils
 from rhasspyhermes.base import Message
 from rhasspyhermes.client import GeneratorType, HermesClient, TopicArgs
 from rhasspyhermes.intent import Intent, Slot, SlotRange
@@ -20,10 +25,20 @@ from rhasspyhermes.nlu import (
     NluTrain,
     NluTrainSuccess,
 )
+from rhasspynlu.fsticuffs import path_to_recognition
 from rhasspynlu.jsgf import Sentence
 
+from .train import train as train_examples
+from .utils import ExampleChoices, ExampleRow, ExamplesType
+
 _LOGGER = logging.getLogger("rhasspyfuzzywuzzy_hermes")
 
+# Number replacement is skipped for input without digits
+_DIGIT_PATTERN = re.compile(r"\d")
+
+# (input text, intent filter)
+RecognitionCacheKey = typing.Tuple[str, typing.FrozenSet[str]]
+
 # -----------------------------------------------------------------------------
 
 
@@ -35,6 +50,7 @@ class NluHermesMqtt(HermesClient):
         client,
         intent_graph: typing.Optional[nx.DiGraph] = None,
         intent_graph_path: typing.Optional[Path] = None,
+        examples: typing.Optional[ExamplesType] = None,
         examples_path: typing.Optional[Path] = None,
         sentences: typing.Optional[typing.List[Path]] = None,
         default_entities: typing.Dict[str, typing.Iterable[Sentence]] = None,
@@ -47,6 +63,7 @@ class NluHermesMqtt(HermesClient):
         ] = None,
         site_ids: typing.Optional[typing.List[str]] = None,
         lang: typing.Optional[str] = None,
+        recognition_cache_size: int = 128,
     ):
         super().__init__("rhasspyfuzzywuzzy_hermes", client, site_ids=site_ids)
 
@@ -56,7 +73,17 @@ class NluHermesMqtt(HermesClient):
         self.intent_graph = intent_graph
         self.intent_graph_path = intent_graph_path
 
-        # Examples
+        # Recent recognition results (cleared when examples change)
+        self.recognition_cache_size = recognition_cache_size
+        self._recognition_cache: typing.OrderedDict[
+            RecognitionCacheKey, typing.List[rhasspynlu.intent.Recognition]
+        ] = OrderedDict()
+
+        # Examples (flattened once; no per-example paths are kept)
+        self._examples: typing.Optional[ExampleChoices] = None
+        if examples is not None:
+            self.examples = ExampleChoices.from_examples(examples)
+
         self.examples_path = examples_path
 
         self.sentences = sentences or []
@@ -73,6 +100,17 @@ class NluHermesMqtt(HermesClient):
 
         self.lang = lang
 
+    @property
+    def examples(self) -> typing.Optional[ExampleChoices]:
+        """Intent examples prepared for matching."""
+        return self._examples
+
+    @examples.setter
+    def examples(self, value: typing.Optional[ExampleChoices]):
+        """Set intent examples and clear cached recognitions."""
+        self._examples = value
+        self._recognition_cache.clear()
+
     # -------------------------------------------------------------------------
 
     async def handle_query(
@@ -93,27 +131,29 @@ class NluHermesMqtt(HermesClient):
                 and self.intent_graph_path
                 and self.intent_graph_path.is_file()
             ):
-                _LOGGER.debug("Loading %s", self.intent_graph_path)
-                with open(self.intent_graph_path, mode="rb") as graph_file:
-                    self.intent_graph = rhasspynlu.gzip_pickle_to_graph(graph_file)
+                self.intent_graph = self.load_intent_graph(self.intent_graph_path)
 
             # Check examples
             if (
-                self.intent_graph
+                (self.examples is None)
+                and self.intent_graph
                 and self.examples_path
                 and self.examples_path.is_file()
             ):
+                _LOGGER.debug("Loading %s", self.examples_path)
+                self.examples = self.load_examples()
+
+            if self.intent_graph and (self.examples is not None):
 
-                def intent_filter(intent_name: str) -> bool:
-                    """Filter out intents."""
-                    if query.intent_filter:
-                        return intent_name in query.intent_filter
-                    return True
+                # Filter out intents
+                intent_filter: typing.Optional[typing.Callable[[str], bool]] = None
+                if query.intent_filter:
+                    intent_filter = set(query.intent_filter).__contains__
 
                 original_text = query.input
 
                 # Replace digits with words
-                if self.replace_numbers:
+                if self.replace_numbers and _DIGIT_PATTERN.search(query.input):
                     # Have to assume whitespace tokenization
                     words = rhasspynlu.replace_numbers(
                         query.input.split(), self.language
@@ -129,13 +169,29 @@ class NluHermesMqtt(HermesClient):
                 recognitions: typing.List[rhasspynlu.intent.Recognition] = []
 
                 if input_text:
-                    recognitions = rhasspyfuzzywuzzy.recognize(
-                        input_text,
-                        self.intent_graph,
-                        str(self.examples_path),
-                        intent_filter=intent_filter,
-                        extra_converters=self.extra_converters,
-                    )
+                    cache_key = (input_text, frozenset(query.intent_filter or ()))
+                    cached_recognitions = self._recognition_cache.get(cache_key)
+
+                    if cached_recognitions is None:
+                        recognitions = self.recognize(
+                            input_text,
+                            intent_filter=intent_filter,
+                            min_confidence=(self.confidence_threshold * 100),
+                        )
+
+                        if self.recognition_cache_size > 0:
+                            # Cache both positive and negative results
+                            self._recognition_cache[cache_key] = recognitions
+                            if (
+                                len(self._recognition_cache)
+                                > self.recognition_cache_size
+                            ):
+                                # Drop least recently used
+                                self._recognition_cache.popitem(last=False)
+                    else:
+                        _LOGGER.debug("Using cached recognition for %s", input_text)
+                        self._recognition_cache.move_to_end(cache_key)
+                        recognitions = cached_recognitions
             else:
                 _LOGGER.error("No intent graph or examples loaded")
                 recognitions = []
@@ -229,6 +285,143 @@ class NluHermesMqtt(HermesClient):
 
     # -------------------------------------------------------------------------
 
+    def recognize(
+        self,
+        input_text: str,
+        intent_filter: typing.Optional[typing.Callable[[str], bool]] = None,
+        min_confidence: float = 0.0,
+    ) -> typing.List[rhasspynlu.intent.Recognition]:
+        """Find the closest matching intent(s).
+
+        Examples scoring below min_confidence (0-100) are never matched.
+        """
+        assert self.intent_graph is not None, "No intent graph"
+        assert self.examples is not None, "No examples"
+
+        start_time = time.perf_counter()
+        choices = self.examples
+
+        # Choices were already processed in ExampleChoices
+        processed_text = rf_utils.default_process(input_text)
+
+        if (not choices) or (not processed_text):
+            return []
+
+        # Find closest match
+        result = choices.match(
+            processed_text, score_cutoff=min_confidence, intent_filter=intent_filter
+        )
+        _LOGGER.debug("input=%s, match=%s", input_text, result)
+
+        if not result:
+            return []
+
+        best_score, best_index = result
+        best_path = choices.get_path(best_index)
+
+        end_time = time.perf_counter()
+        _, recognition = path_to_recognition(
+            best_path, self.intent_graph, extra_converters=self.extra_converters
+        )
+
+        if (not recognition) or (not recognition.intent):
+            return []
+
+        recognition.intent.confidence = best_score / 100.0
+        recognition.recognize_seconds = end_time - start_time
+        recognition.raw_text = input_text
+        recognition.raw_tokens = input_text.split()
+
+        return [recognition]
+
+    def load_intent_graph(self, graph_path: Path, use_cache: bool = True) -> nx.DiGraph:
+        """Load gzipped intent graph, preferring an uncompressed pickle cache.
+
+        The cache is only used if it was written from a graph file with the
+        same size and modification time. It is always rewritten after the
+        gzipped graph is loaded.
+        """
+        cache_path = graph_path.with_name(graph_path.name + ".cache")
+        graph_stat = graph_path.stat()
+        graph_key = (graph_stat.st_size, graph_stat.st_mtime_ns)
+
+        if use_cache and cache_path.is_file():
+            try:
+                with open(cache_path, mode="rb") as cache_file:
+                    # Cache starts with (size, mtime) of the graph it came from
+                    if pickle.load(cache_file) == graph_key:
+                        _LOGGER.debug("Loading %s", cache_path)
+                        return pickle.load(cache_file)
+            except Exception:
+                _LOGGER.warning("Failed to read intent graph cache %s", cache_path)
+
+        _LOGGER.debug("Loading %s", graph_path)
+        with open(graph_path, mode="rb") as graph_file:
+            intent_graph = rhasspynlu.gzip_pickle_to_graph(graph_file)
+
+        # Skip decompression next time (best effort)
+        temp_path = cache_path.with_name(cache_path.name + ".tmp")
+        try:
+            with open(temp_path, mode="wb") as cache_file:
+                pickle.dump(graph_key, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(intent_graph, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+            temp_path.replace(cache_path)
+            _LOGGER.debug("Wrote %s", cache_path)
+        except Exception:
+            _LOGGER.warning("Failed to write intent graph cache %s", cache_path)
+            if temp_path.is_file():
+                temp_path.unlink()
+
+        return intent_graph
+
+    def load_examples(self) -> ExampleChoices:
+        """Load intent examples from SQLite database."""
+        assert self.intent_graph is not None, "No intent graph"
+        assert self.examples_path is not None, "No examples path"
+
+        conn = sqlite3.connect(str(self.examples_path))
+        try:
+            c = conn.cursor()
+            c.execute("SELECT sentence, path FROM intents ORDER BY rowid")
+
+            # Rows are flattened as they are read
+            return ExampleChoices(self.read_example_rows(c))
+        finally:
+            conn.close()
+
+    def read_example_rows(
+        self, rows: typing.Iterable[typing.Tuple[str, typing.Any]]
+    ) -> typing.Iterable[ExampleRow]:
+        """Decode (sentence, path) database rows."""
+        for sentence, path_value in rows:
+            path: typing.Sequence[int]
+            if isinstance(path_value, bytes):
+                # Packed little-endian int32 node ids
+                path = np.frombuffer(path_value, dtype="<i4")
+            else:
+                # JSON list from older databases
+                path = json.loads(path_value)
+
+            yield (self.path_intent_name(path), sentence, path)
+
+    def path_intent_name(self, path: typing.Iterable[int]) -> str:
+        """Get name of intent from __label__ on a path through the intent graph."""
+        assert self.intent_graph is not None, "No intent graph"
+
+        from_node: typing.Optional[int] = None
+        for to_node in path:
+            if from_node is not None:
+                olabel = self.intent_graph.edges[(from_node, to_node)].get("olabel", "")
+                if olabel.startswith("__label__"):
+                    return olabel[9:]
+
+            from_node = to_node
+
+        return ""
+
+    # -------------------------------------------------------------------------
+
     async def handle_train(
         self, train: NluTrain, site_id: str = "default"
     ) -> typing.AsyncIterable[
@@ -236,11 +429,14 @@ class NluHermesMqtt(HermesClient):
     ]:
         """Transform sentences to intent examples"""
         try:
-            _LOGGER.debug("Loading %s", train.graph_path)
-            with open(train.graph_path, mode="rb") as graph_file:
-                self.intent_graph = rhasspynlu.gzip_pickle_to_graph(graph_file)
+            # Always decode the graph being trained, never a cached copy
+            self.intent_graph = self.load_intent_graph(
+                Path(train.graph_path), use_cache=False
+            )
 
-            examples = rhasspyfuzzywuzzy.train(self.intent_graph)
+            # Training output is only kept until it has been written out
+            examples = train_examples(self.intent_graph)
+            self.examples = ExampleChoices.from_examples(examples)
 
             if self.examples_path:
                 if self.examples_path.is_file():
@@ -251,14 +447,18 @@ class NluHermesMqtt(HermesClient):
                 conn = sqlite3.connect(str(self.examples_path))
                 c = conn.cursor()
                 c.execute("""DROP TABLE IF EXISTS intents""")
-                c.execute("""CREATE TABLE intents (sentence text, path text)""")
-
-                for _, sentences in examples.items():
-                    for sentence, path in sentences.items():
-                        c.execute(
-                            "INSERT INTO intents VALUES (?, ?)",
-                            (sentence, json.dumps(path, ensure_ascii=False)),
-                        )
+                c.execute("""CREATE TABLE intents (sentence text, path blob)""")
+
+                # Paths are stored as packed little-endian int32 node ids, so the
+                # database reads the same on any host
+                c.executemany(
+                    "INSERT INTO intents VALUES (?, ?)",
+                    (
+                        (sentence, np.asarray(path, dtype="<i4").tobytes())
+                        for sentences in examples.values()
+                        for sentence, path in sentences.items()
+                    ),
+                )
 
                 conn.commit()
                 conn.close()
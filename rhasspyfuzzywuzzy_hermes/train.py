@@ -0,0 +1,67 @@
+"""Training methods for rhasspy-fuzzywuzzy-hermes"""
+import array
+import logging
+import typing
+from collections import defaultdict
+
+import networkx as nx
+import rhasspynlu
+from rapidfuzz import utils as rf_utils
+
+from .utils import ExamplesType
+
+_LOGGER = logging.getLogger("rhasspyfuzzywuzzy_hermes")
+
+# -----------------------------------------------------------------------------
+
+
+def train(intent_graph: nx.DiGraph) -> ExamplesType:
+    """Generate examples from intent graph."""
+
+    # Generate all possible intents
+    _LOGGER.debug("Generating examples")
+    examples: ExamplesType = defaultdict(dict)
+    for intent_name, sentence, path in generate_examples(intent_graph):
+        sentence = rf_utils.default_process(sentence)
+
+        # Packed int32 node ids instead of a list of boxed ints
+        examples[intent_name][sentence] = array.array("i", path)
+
+    _LOGGER.debug("Examples generated")
+
+    return examples
+
+
+# -----------------------------------------------------------------------------
+
+
+def generate_examples(
+    intent_graph: nx.DiGraph,
+) -> typing.Iterable[typing.Tuple[str, str, typing.List[int]]]:
+    """Generate all possible (intent name, sentence, path) from an intent graph."""
+    n_data = intent_graph.nodes(data=True)
+
+    # Get start/end nodes for graph
+    start_node, end_node = rhasspynlu.jsgf_graph.get_start_end_nodes(intent_graph)
+    assert (start_node is not None) and (
+        end_node is not None
+    ), "Missing start/end node(s)"
+
+    # Generate all sentences/paths
+    paths = nx.all_simple_paths(intent_graph, start_node, end_node)
+    for path in paths:
+        assert len(path) > 2
+
+        # First edge has intent name (__label__INTENT)
+        olabel = intent_graph.edges[(path[0], path[1])]["olabel"]
+        assert olabel.startswith("__label__")
+        intent_name = olabel[9:]
+
+        # Words are joined once here instead of by each caller
+        words = []
+        for node in path:
+            word = n_data[node].get("word")
+            if word:
+                words.append(word)
+
+        yield (intent_name, " ".join(words), path)
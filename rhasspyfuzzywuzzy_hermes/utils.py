@@ -1,13 +1,32 @@
 """Utility methods for rhasspy-fuzzywuzzy-hermes"""
-import io
+import array
 import json
 import logging
 import subprocess
 import typing
+from collections import defaultdict
 from pathlib import Path
 
+import numpy as np
+from rapidfuzz import fuzz as rf_fuzz
+from rapidfuzz import process as rf_process
+from rapidfuzz import utils as rf_utils
+
 _LOGGER = logging.getLogger("rhasspyfuzzywuzzy_hermes")
 
+# intent name -> sentence -> graph path
+ExamplesType = typing.Dict[str, typing.Dict[str, typing.Sequence[int]]]
+
+# (intent name, sentence, graph path)
+ExampleRow = typing.Tuple[str, str, typing.Sequence[int]]
+
+# Fewer choices than this are matched with extractOne on the calling thread
+MIN_PARALLEL_CHOICES = 500
+
+# More candidates than this are first filtered with a character n-gram index
+NGRAM_MIN_CHOICES = 10000
+NGRAM_SIZE = 3
+
 
 # -----------------------------------------------------------------------------
 
@@ -29,17 +48,17 @@ class CliConverter:
             universal_newlines=True,
         )
 
-        with io.StringIO() as input_file:
-            if len(args) == 1:
-                # Single value
-                json.dump(args[0], input_file)
-            elif len(args) > 1:
-                # Multiple values as list
-                json.dump(args, input_file)
+        input_text = ""
+        if len(args) == 1:
+            # Single value
+            input_text = json.dumps(args[0])
+        elif len(args) > 1:
+            # Multiple values as list
+            input_text = json.dumps(args)
 
-            stdout, _ = proc.communicate(input=input_file.getvalue())
+        stdout, _ = proc.communicate(input=input_text)
 
-            return [json.loads(line) for line in stdout.splitlines() if line.strip()]
+        return [json.loads(line) for line in stdout.splitlines() if line.strip()]
 
 
 def load_converters(converters_dir: Path,) -> typing.Dict[str, typing.Any]:
@@ -68,3 +87,288 @@ def load_converters(converters_dir: Path,) -> typing.Dict[str, typing.Any]:
             _LOGGER.debug("Loaded converter %s from %s", converter_name, converter_path)
 
     return converters
+
+
+# -----------------------------------------------------------------------------
+
+# Number of set bits in each byte value
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class ExampleChoices:
+    """Intent examples flattened into parallel lists/arrays for fuzzy matching"""
+
+    def __init__(self, rows: typing.Iterable[ExampleRow]):
+        # Sentences are processed once here instead of on every query
+        self.texts: typing.List[str] = []
+        self.intent_names: typing.List[str] = []
+
+        # All paths back to back; path i is all_paths[offsets[i]:offsets[i + 1]]
+        paths = array.array("i")
+        path_lengths = array.array("i")
+
+        for intent_name, text, path in rows:
+            self.texts.append(rf_utils.default_process(text))
+            self.intent_names.append(intent_name)
+            paths.extend(path)
+            path_lengths.append(len(path))
+
+        # Views over the packed buffers (no copy)
+        self.all_paths = np.frombuffer(paths, dtype=np.int32)
+        self.path_offsets = np.zeros(len(path_lengths) + 1, dtype=np.int64)
+        np.cumsum(
+            np.frombuffer(path_lengths, dtype=np.int32), out=self.path_offsets[1:]
+        )
+
+        # Processed sentence -> index of first example with it
+        self.text_indexes: typing.Dict[str, int] = {}
+        for text_index, text in enumerate(self.texts):
+            self.text_indexes.setdefault(text, text_index)
+
+        self.lengths = np.array([len(t) for t in self.texts], dtype=np.int32)
+
+        # Example indexes ordered by length, for binary search on length windows
+        self.length_order = np.argsort(self.lengths, kind="stable")
+        self.sorted_lengths = self.lengths[self.length_order]
+
+        self.char_bitmaps = build_char_bitmaps(self.texts)
+
+        # n-gram -> indexes of examples containing it
+        self.ngram_postings: typing.Dict[str, np.ndarray] = {}
+        if len(self.texts) > NGRAM_MIN_CHOICES:
+            self.ngram_postings = build_ngram_postings(self.texts)
+
+    @classmethod
+    def from_examples(cls, examples: ExamplesType) -> "ExampleChoices":
+        """Flatten examples from training"""
+        return cls(
+            (intent_name, text, path)
+            for intent_name, intent_paths in examples.items()
+            for text, path in intent_paths.items()
+        )
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def get_path(self, index: int) -> typing.List[int]:
+        """Get intent graph path of an example"""
+        return self.all_paths[
+            self.path_offsets[index] : self.path_offsets[index + 1]
+        ].tolist()
+
+    def match(
+        self,
+        query: str,
+        score_cutoff: float = 0.0,
+        intent_filter: typing.Optional[typing.Callable[[str], bool]] = None,
+    ) -> typing.Optional[typing.Tuple[float, int]]:
+        """Find (score, index) of the closest example to processed query"""
+        exact_index = self.text_indexes.get(query)
+        if (exact_index is not None) and (
+            (intent_filter is None) or intent_filter(self.intent_names[exact_index])
+        ):
+            # Exact match is always the first best match, so skip scoring
+            return (100.0, exact_index)
+
+        # Indexes of examples to score (None for all)
+        candidates: typing.Optional[np.ndarray] = None
+        if intent_filter is not None:
+            candidates = self.filter_intents(intent_filter)
+
+        candidates = self.prune(query, score_cutoff, candidates)
+        candidates = self.filter_ngrams(query, score_cutoff, candidates)
+
+        if candidates is None:
+            texts = self.texts
+        else:
+            texts = [self.texts[i] for i in candidates]
+
+        if not texts:
+            return None
+
+        result = extract_best(query, texts, score_cutoff=score_cutoff)
+        if (not result) or (candidates is None):
+            return result
+
+        # Map back to example index
+        best_score, best_index = result
+        return (best_score, int(candidates[best_index]))
+
+    def filter_intents(self, intent_filter: typing.Callable[[str], bool]) -> np.ndarray:
+        """Get indexes of examples whose intents pass the filter"""
+        allowed = {name: intent_filter(name) for name in set(self.intent_names)}
+        return np.fromiter(
+            (i for i, name in enumerate(self.intent_names) if allowed[name]),
+            dtype=np.int64,
+        )
+
+    def prune(
+        self,
+        query: str,
+        score_cutoff: float,
+        candidates: typing.Optional[np.ndarray] = None,
+    ) -> typing.Optional[np.ndarray]:
+        """Drop candidate indexes that cannot reach score_cutoff against query.
+
+        Candidates are first limited to a window of lengths around the query.
+        Then every character present in only one of two strings costs at least
+        one insertion/deletion, so the popcount of their XORed character
+        bitmaps bounds fuzz.ratio from above.
+        """
+        if score_cutoff <= 0:
+            # Nothing can be pruned
+            return candidates
+
+        # Length difference alone costs insertions/deletions, so only examples
+        # within a window around the query length can reach the cutoff.
+        cutoff_ratio = min(score_cutoff, 100) / 100
+        min_length = len(query) * cutoff_ratio / (2 - cutoff_ratio)
+        max_length = len(query) * (2 - cutoff_ratio) / cutoff_ratio
+        window_start = np.searchsorted(
+            self.sorted_lengths, min_length - 1e-6, side="left"
+        )
+        window_end = np.searchsorted(
+            self.sorted_lengths, max_length + 1e-6, side="right"
+        )
+
+        # Back in original example order so ties are broken as before
+        in_window = np.sort(self.length_order[window_start:window_end])
+
+        if candidates is None:
+            candidates = in_window
+        else:
+            window_mask = np.zeros(len(self.texts), dtype=bool)
+            window_mask[in_window] = True
+            candidates = candidates[window_mask[candidates]]
+
+        query_bitmap = build_char_bitmaps([query])
+        different_chars = _POPCOUNT_TABLE[
+            (self.char_bitmaps[candidates] ^ query_bitmap).view(np.uint8)
+        ].sum(axis=1, dtype=np.int32)
+
+        total_lengths = self.lengths[candidates] + len(query)
+        max_scores = 100 * (1 - (different_chars / total_lengths))
+
+        # Small tolerance for float rounding against rapidfuzz's own scores
+        return candidates[max_scores >= (score_cutoff - 1e-6)]
+
+    def filter_ngrams(
+        self,
+        query: str,
+        score_cutoff: float,
+        candidates: typing.Optional[np.ndarray] = None,
+    ) -> typing.Optional[np.ndarray]:
+        """Drop candidate indexes sharing too few n-grams with query.
+
+        Each insertion/deletion changes at most NGRAM_SIZE of the query's
+        n-grams, so an example within indel distance d of the query still has
+        all but d * NGRAM_SIZE of its distinct n-grams (q-gram count lemma).
+        The largest d allowed by score_cutoff gives the minimum shared count.
+        """
+        if score_cutoff <= 0:
+            # Nothing can be filtered
+            return candidates
+
+        num_candidates = len(self.texts) if candidates is None else len(candidates)
+        if (not self.ngram_postings) or (num_candidates <= NGRAM_MIN_CHOICES):
+            return candidates
+
+        query_ngrams = set(get_ngrams(query))
+        postings = [
+            self.ngram_postings[ngram]
+            for ngram in query_ngrams
+            if ngram in self.ngram_postings
+        ]
+
+        if candidates is None:
+            candidates = np.arange(len(self.texts))
+
+        hits = np.zeros(len(self.texts), dtype=np.int64)
+        if postings:
+            hits += np.bincount(np.concatenate(postings), minlength=len(self.texts))
+
+        # fuzz.ratio >= cutoff means indel distance <= (1 - cutoff) * total length
+        cutoff_ratio = min(score_cutoff, 100) / 100
+        total_lengths = self.lengths[candidates] + len(query)
+        max_distances = np.floor((1 - cutoff_ratio) * total_lengths + 1e-6)
+        min_hits = len(query_ngrams) - (NGRAM_SIZE * max_distances)
+
+        return candidates[hits[candidates] >= min_hits]
+
+
+def get_ngrams(text: str, n: int = NGRAM_SIZE) -> typing.Iterable[str]:
+    """Yield character n-grams of text padded with spaces"""
+    padded_text = f" {text} "
+    for i in range(len(padded_text) - n + 1):
+        yield padded_text[i : i + n]
+
+
+def build_ngram_postings(texts: typing.Sequence[str]) -> typing.Dict[str, np.ndarray]:
+    """Build an inverted index from character n-gram to text indexes"""
+    # Packed int32 indexes instead of lists of boxed ints
+    postings: typing.Dict[str, array.array] = defaultdict(lambda: array.array("i"))
+    for text_index, text in enumerate(texts):
+        for ngram in set(get_ngrams(text)):
+            postings[ngram].append(text_index)
+
+    # Views over the packed buffers (no copy)
+    return {
+        ngram: np.frombuffer(text_indexes, dtype=np.int32)
+        for ngram, text_indexes in postings.items()
+    }
+
+
+def build_char_bitmaps(texts: typing.Sequence[str]) -> np.ndarray:
+    """Build 256-bit character presence bitmaps as an (N, 4) uint64 array.
+
+    Characters are folded into 256 bits by code point, which can only make two
+    bitmaps look more alike.
+    """
+    bitmap_bytes = bytearray()
+    for text in texts:
+        bitmap = 0
+        for char in set(text):
+            bitmap |= 1 << (ord(char) & 0xFF)
+
+        bitmap_bytes += bitmap.to_bytes(32, "little")
+
+    return np.frombuffer(bytes(bitmap_bytes), dtype=np.uint64).reshape(-1, 4)
+
+
+# -----------------------------------------------------------------------------
+
+
+def extract_best(
+    query: str, choices: typing.Sequence[str], score_cutoff: float = 0.0
+) -> typing.Optional[typing.Tuple[float, int]]:
+    """Find (score, index) of closest processed choice, or None if below cutoff"""
+    if len(choices) < MIN_PARALLEL_CHOICES:
+        result = rf_process.extractOne(
+            query,
+            choices,
+            scorer=rf_fuzz.ratio,
+            processor=None,
+            score_cutoff=score_cutoff,
+        )
+
+        return (result[1], result[2]) if result else None
+
+    # Score all choices in one batched call across all cores.
+    # Scores are doubles, like extractOne, so near ties are broken the same way.
+    scores = rf_process.cdist(
+        [query],
+        choices,
+        scorer=rf_fuzz.ratio,
+        processor=None,
+        score_cutoff=score_cutoff,
+        dtype=np.float64,
+        workers=-1,
+    )[0]
+
+    # argmax returns the first best index, like extractOne
+    best_index = int(scores.argmax())
+    best_score = float(scores[best_index])
+    if best_score < score_cutoff:
+        return None
+
+    return (best_score, best_index)
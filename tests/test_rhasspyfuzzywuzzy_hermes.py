@@ -1,13 +1,20 @@
 """Unit tests for rhasspyfuzzwuzzy_hermes"""
 import asyncio
+import json
 import logging
+import os
+import pickle
+import random
+import sqlite3
+import struct
 import tempfile
 import unittest
 import uuid
 from pathlib import Path
 from unittest.mock import MagicMock, patch
 
-import rhasspyfuzzywuzzy
+from rapidfuzz import fuzz as rf_fuzz
+from rapidfuzz import process as rf_process
 from rhasspyhermes.intent import Intent, Slot, SlotRange
 from rhasspyhermes.nlu import (
     NluError,
@@ -18,14 +25,58 @@ from rhasspyhermes.nlu import (
     NluTrain,
     NluTrainSuccess,
 )
-from rhasspynlu import intents_to_graph, parse_ini
+from rhasspynlu import (
+    graph_to_gzip_pickle,
+    intents_to_graph,
+    parse_ini,
+    replace_numbers,
+)
 
 from rhasspyfuzzywuzzy_hermes import NluHermesMqtt
+from rhasspyfuzzywuzzy_hermes.train import train as train_examples
+from rhasspyfuzzywuzzy_hermes.utils import (
+    MIN_PARALLEL_CHOICES,
+    NGRAM_MIN_CHOICES,
+    ExampleChoices,
+    extract_best,
+)
 
 _LOGGER = logging.getLogger(__name__)
 _LOOP = asyncio.get_event_loop()
 
 
+def write_graph(graph, graph_path: Path):
+    """Write intent graph as a gzipped pickle."""
+    with open(graph_path, mode="wb") as graph_file:
+        graph_to_gzip_pickle(graph, graph_file)
+
+
+def make_sentences(num_sentences: int, seed: int = 0):
+    """Generate distinct random lower-case sentences."""
+    rand = random.Random(seed)
+    words = [
+        "".join(
+            rand.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rand.randint(2, 7))
+        )
+        for _ in range(200)
+    ]
+
+    sentences = set()
+    while len(sentences) < num_sentences:
+        sentences.add(" ".join(rand.choice(words) for _ in range(rand.randint(3, 8))))
+
+    return sorted(sentences)
+
+
+def extract_one(query: str, choices, score_cutoff: float = 0.0):
+    """Reference (score, index) from a plain extractOne scan."""
+    result = rf_process.extractOne(
+        query, choices, scorer=rf_fuzz.ratio, processor=None, score_cutoff=score_cutoff
+    )
+
+    return (result[1], result[2]) if result else None
+
+
 class RhasspyFuzzywuzzyHermesTestCase(unittest.TestCase):
     """Tests for rhasspyfuzzywuzzy_hermes"""
 
@@ -42,7 +93,7 @@ class RhasspyFuzzywuzzyHermesTestCase(unittest.TestCase):
         """
 
         self.graph = intents_to_graph(parse_ini(ini_text))
-        self.examples = rhasspyfuzzywuzzy.train(self.graph)
+        self.examples = train_examples(self.graph)
         self.client = MagicMock()
         self.hermes = NluHermesMqtt(
             self.client,
@@ -200,28 +251,134 @@ class RhasspyFuzzywuzzyHermesTestCase(unittest.TestCase):
 
     # -------------------------------------------------------------------------
 
+    async def async_test_recognition_cache(self):
+        """Verify repeated queries are recognized from the cache."""
+        text = "set the bedroom light to red"
+
+        with patch.object(
+            self.hermes, "recognize", wraps=self.hermes.recognize
+        ) as recognize:
+            for _ in range(2):
+                query = NluQuery(
+                    input=text,
+                    id=str(uuid.uuid4()),
+                    site_id=self.site_id,
+                    session_id=self.session_id,
+                )
+
+                results = []
+                async for result in self.hermes.on_message(query):
+                    results.append(result)
+
+                # Ignore intentParsed
+                nlu_intent = results[1][0]
+                self.assertIsInstance(nlu_intent, NluIntent)
+                self.assertEqual(nlu_intent.intent.intent_name, "SetLightColor")
+
+            # Second query should come from cache
+            self.assertEqual(recognize.call_count, 1)
+
+            # Cache is cleared when examples change
+            self.hermes.examples = ExampleChoices.from_examples(self.examples)
+            async for result in self.hermes.on_message(query):
+                pass
+
+            self.assertEqual(recognize.call_count, 2)
+
+    def test_recognition_cache(self):
+        """Call async_test_recognition_cache."""
+        _LOOP.run_until_complete(self.async_test_recognition_cache())
+
+    # -------------------------------------------------------------------------
+
+    def test_replace_numbers(self):
+        """Verify numbers are only replaced in input that has digits."""
+        graph = intents_to_graph(
+            parse_ini(
+                """
+                [SetTimer]
+                set timer for five minutes
+
+                [GetTime]
+                what time is it
+                """
+            )
+        )
+        hermes = NluHermesMqtt(
+            self.client,
+            graph,
+            examples=train_examples(graph),
+            replace_numbers=True,
+            confidence_threshold=1.0,
+            site_ids=[self.site_id],
+        )
+
+        with patch(
+            "rhasspynlu.replace_numbers", wraps=replace_numbers
+        ) as mock_replace_numbers:
+            for text, intent_name in [
+                ("what time is it", "GetTime"),
+                ("set timer for 5 minutes", "SetTimer"),
+            ]:
+                query = NluQuery(
+                    input=text,
+                    id=str(uuid.uuid4()),
+                    site_id=self.site_id,
+                    session_id=self.session_id,
+                )
+                results = _LOOP.run_until_complete(self.collect(query, hermes))
+                self.assertEqual(results[1][0].intent.intent_name, intent_name)
+
+                # Only called once digits show up
+                if intent_name == "GetTime":
+                    mock_replace_numbers.assert_not_called()
+
+            mock_replace_numbers.assert_called_once()
+            self.assertEqual(
+                mock_replace_numbers.call_args[0][0],
+                ["set", "timer", "for", "5", "minutes"],
+            )
+
+    # -------------------------------------------------------------------------
+
+    def test_exact_match(self):
+        """Verify exact matches skip fuzzy scoring."""
+        with patch("rhasspyfuzzywuzzy_hermes.utils.extract_best") as scorer:
+            recognitions = self.hermes.recognize("Set the bedroom light to red!")
+            scorer.assert_not_called()
+
+        self.assertEqual(len(recognitions), 1)
+        self.assertEqual(recognitions[0].intent.name, "SetLightColor")
+        self.assertEqual(recognitions[0].intent.confidence, 1.0)
+
+        # Exact match from a filtered intent still goes through scoring
+        with patch(
+            "rhasspyfuzzywuzzy_hermes.utils.extract_best", wraps=extract_best
+        ) as scorer:
+            recognitions = self.hermes.recognize(
+                "what time is it", intent_filter=lambda name: name == "SetLightColor"
+            )
+            scorer.assert_called_once()
+
+        self.assertEqual(len(recognitions), 1)
+        self.assertEqual(recognitions[0].intent.name, "SetLightColor")
+        self.assertLess(recognitions[0].intent.confidence, 1.0)
+
+    # -------------------------------------------------------------------------
+
     async def async_test_train_success(self):
         """Verify successful training."""
         train_id = str(uuid.uuid4())
 
-        def fake_read_graph(*args, **kwargs):
-            return MagicMock()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            graph_path = Path(temp_dir) / "intent_graph.pickle.gz"
+            write_graph(self.graph, graph_path)
 
-        def fake_train(*args, **kwargs):
-            return MagicMock()
+            train = NluTrain(id=train_id, graph_path=str(graph_path))
 
-        # Create temporary file for "open"
-        with tempfile.NamedTemporaryFile(mode="wb+", suffix=".gz") as graph_file:
-            train = NluTrain(id=train_id, graph_path=graph_file.name)
-
-            # Ensure fake graph "loads" and training goes through
-            with patch("rhasspynlu.gzip_pickle_to_graph", new=fake_read_graph):
-                with patch("rhasspyfuzzywuzzy.train", new=fake_train):
-                    results = []
-                    async for result in self.hermes.on_message(
-                        train, site_id=self.site_id
-                    ):
-                        results.append(result)
+            results = []
+            async for result in self.hermes.on_message(train, site_id=self.site_id):
+                results.append(result)
 
             self.assertEqual(
                 results, [(NluTrainSuccess(id=train_id), {"site_id": self.site_id})]
@@ -233,6 +390,217 @@ class RhasspyFuzzywuzzyHermesTestCase(unittest.TestCase):
 
     # -------------------------------------------------------------------------
 
+    def test_intent_graph_cache(self):
+        """Verify intent graph cache is only used for the same graph file."""
+        other_graph = intents_to_graph(parse_ini("[PlayMusic]\nplay some music"))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            graph_path = Path(temp_dir) / "intent_graph.pickle.gz"
+            cache_path = Path(temp_dir) / "intent_graph.pickle.gz.cache"
+            write_graph(self.graph, graph_path)
+
+            # First load writes cache
+            self.hermes.load_intent_graph(graph_path)
+            self.assertTrue(cache_path.is_file())
+
+            # Second load skips decompression
+            with patch("rhasspynlu.gzip_pickle_to_graph") as read_graph:
+                intent_graph = self.hermes.load_intent_graph(graph_path)
+                read_graph.assert_not_called()
+
+            self.assertEqual(
+                set(train_examples(intent_graph)), {"SetLightColor", "GetTime"}
+            )
+
+            # Replace graph, but keep the old modification time
+            graph_stat = graph_path.stat()
+            write_graph(other_graph, graph_path)
+            os.utime(graph_path, ns=(graph_stat.st_atime_ns, graph_stat.st_mtime_ns))
+
+            intent_graph = self.hermes.load_intent_graph(graph_path)
+            self.assertEqual(set(train_examples(intent_graph)), {"PlayMusic"})
+
+    def test_train_ignores_graph_cache(self):
+        """Verify training never uses a cached intent graph."""
+        other_graph = intents_to_graph(parse_ini("[PlayMusic]\nplay some music"))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            graph_path = Path(temp_dir) / "intent_graph.pickle.gz"
+            cache_path = Path(temp_dir) / "intent_graph.pickle.gz.cache"
+            write_graph(other_graph, graph_path)
+
+            # Stale cache that matches the size/time of the new graph
+            graph_stat = graph_path.stat()
+            with open(cache_path, mode="wb") as cache_file:
+                pickle.dump((graph_stat.st_size, graph_stat.st_mtime_ns), cache_file)
+                pickle.dump(self.graph, cache_file)
+
+            train = NluTrain(id=str(uuid.uuid4()), graph_path=str(graph_path))
+            results = _LOOP.run_until_complete(self.collect(train))
+            self.assertIsInstance(results[0][0], NluTrainSuccess)
+
+            recognitions = self.hermes.recognize("play some music")
+            self.assertEqual(len(recognitions), 1)
+            self.assertEqual(recognitions[0].intent.name, "PlayMusic")
+
+            # Cache was rewritten from the trained graph
+            intent_graph = self.hermes.load_intent_graph(graph_path)
+            self.assertEqual(set(train_examples(intent_graph)), {"PlayMusic"})
+
+    def test_graph_cache_write_failure(self):
+        """Verify a failed cache write does not fail training."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            graph_path = Path(temp_dir) / "intent_graph.pickle.gz"
+            write_graph(self.graph, graph_path)
+
+            train = NluTrain(id=str(uuid.uuid4()), graph_path=str(graph_path))
+            with patch("pickle.dump", side_effect=TypeError("cannot pickle")):
+                results = _LOOP.run_until_complete(self.collect(train))
+
+            self.assertIsInstance(results[0][0], NluTrainSuccess)
+            self.assertEqual(list(Path(temp_dir).iterdir()), [graph_path])
+
+    def test_examples_round_trip(self):
+        """Verify examples written by training are loaded by a new service."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            graph_path = Path(temp_dir) / "intent_graph.pickle.gz"
+            examples_path = Path(temp_dir) / "examples.db"
+            write_graph(self.graph, graph_path)
+
+            self.hermes.examples_path = examples_path
+            train = NluTrain(id=str(uuid.uuid4()), graph_path=str(graph_path))
+            results = _LOOP.run_until_complete(self.collect(train))
+            self.assertIsInstance(results[0][0], NluTrainSuccess)
+
+            # Paths are stored as blobs
+            conn = sqlite3.connect(str(examples_path))
+            path_types = {
+                row[0] for row in conn.execute("SELECT typeof(path) FROM intents")
+            }
+            self.assertEqual(path_types, {"blob"})
+
+            # Blobs are little-endian int32 regardless of host byte order
+            stored_paths = {
+                sentence: list(struct.unpack(f"<{len(path) // 4}i", path))
+                for sentence, path in conn.execute("SELECT sentence, path FROM intents")
+            }
+            conn.close()
+            self.assertEqual(
+                stored_paths,
+                {
+                    sentence: list(path)
+                    for sentences in self.examples.values()
+                    for sentence, path in sentences.items()
+                },
+            )
+
+            self.assert_loads_examples(graph_path, examples_path)
+
+    def test_load_json_examples(self):
+        """Verify examples databases with JSON paths still load."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            graph_path = Path(temp_dir) / "intent_graph.pickle.gz"
+            examples_path = Path(temp_dir) / "examples.db"
+            write_graph(self.graph, graph_path)
+
+            # Format written by earlier versions
+            conn = sqlite3.connect(str(examples_path))
+            conn.execute("CREATE TABLE intents (sentence text, path text)")
+            conn.executemany(
+                "INSERT INTO intents VALUES (?, ?)",
+                [
+                    (sentence, json.dumps(list(path)))
+                    for sentences in self.examples.values()
+                    for sentence, path in sentences.items()
+                ],
+            )
+            conn.commit()
+            conn.close()
+
+            self.assert_loads_examples(graph_path, examples_path)
+
+    def test_empty_examples(self):
+        """Verify an empty examples database is loaded once and matches nothing."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            graph_path = Path(temp_dir) / "intent_graph.pickle.gz"
+            examples_path = Path(temp_dir) / "examples.db"
+            write_graph(self.graph, graph_path)
+
+            conn = sqlite3.connect(str(examples_path))
+            conn.execute("CREATE TABLE intents (sentence text, path blob)")
+            conn.commit()
+            conn.close()
+
+            hermes = NluHermesMqtt(
+                self.client,
+                intent_graph_path=graph_path,
+                examples_path=examples_path,
+                site_ids=[self.site_id],
+            )
+
+            with patch.object(
+                hermes, "load_examples", wraps=hermes.load_examples
+            ) as load_examples:
+                for text in ["set the bedroom light to red", "what time is it"]:
+                    query = NluQuery(
+                        input=text,
+                        id=str(uuid.uuid4()),
+                        site_id=self.site_id,
+                        session_id=self.session_id,
+                    )
+                    results = _LOOP.run_until_complete(self.collect(query, hermes))
+                    self.assertEqual(len(results), 1)
+                    self.assertIsInstance(results[0], NluIntentNotRecognized)
+
+                self.assertEqual(load_examples.call_count, 1)
+
+    def assert_loads_examples(self, graph_path: Path, examples_path: Path):
+        """Check that a new service recognizes intents from an examples database."""
+        hermes = NluHermesMqtt(
+            self.client,
+            intent_graph_path=graph_path,
+            examples_path=examples_path,
+            confidence_threshold=1.0,
+            site_ids=[self.site_id],
+        )
+
+        query = NluQuery(
+            input="set the bedroom light to red",
+            id=str(uuid.uuid4()),
+            site_id=self.site_id,
+            session_id=self.session_id,
+        )
+        results = _LOOP.run_until_complete(self.collect(query, hermes))
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[1][0].intent.intent_name, "SetLightColor")
+        self.assertEqual(
+            {slot.slot_name: slot.raw_value for slot in results[1][0].slots},
+            {"name": "bedroom", "color": "red"},
+        )
+
+        # Intent names are recovered for filtering
+        query = NluQuery(
+            input="what time is it",
+            id=str(uuid.uuid4()),
+            intent_filter=["SetLightColor"],
+            site_id=self.site_id,
+            session_id=self.session_id,
+        )
+        results = _LOOP.run_until_complete(self.collect(query, hermes))
+        self.assertEqual(len(results), 1)
+        self.assertIsInstance(results[0], NluIntentNotRecognized)
+
+    async def collect(self, message, hermes=None):
+        """Collect all results for a message."""
+        hermes = hermes or self.hermes
+        results = []
+        async for result in hermes.on_message(message, site_id=self.site_id):
+            results.append(result)
+
+        return results
+
+    # -------------------------------------------------------------------------
+
     async def async_test_train_error(self):
         """Verify training error."""
         train = NluTrain(id=self.session_id, graph_path=Path("fake-graph.pickle.gz"))
@@ -251,3 +619,131 @@ class RhasspyFuzzywuzzyHermesTestCase(unittest.TestCase):
     def test_train_error(self):
         """Call async_test_train_error."""
         _LOOP.run_until_complete(self.async_test_train_error())
+
+
+# -----------------------------------------------------------------------------
+
+
+class ExtractBestTestCase(unittest.TestCase):
+    """Tests for fuzzy matching utilities"""
+
+    def test_extract_best_cdist(self):
+        """Verify batched scoring matches extractOne."""
+        choices = make_sentences(MIN_PARALLEL_CHOICES + 100)
+        queries = [
+            choices[10],
+            choices[20] + "x",
+            choices[30][1:],
+            choices[40][:-1] + "q",
+            "completely different text",
+        ]
+
+        with patch.object(rf_process, "cdist", wraps=rf_process.cdist) as cdist:
+            for query in queries:
+                for score_cutoff in [0, 50, 90, 100]:
+                    self.assertEqual(
+                        extract_best(query, choices, score_cutoff=score_cutoff),
+                        extract_one(query, choices, score_cutoff=score_cutoff),
+                    )
+
+            self.assertTrue(cdist.called)
+
+        # Every choice is below the cutoff
+        self.assertIsNone(extract_best("zzzzzzzz", choices, score_cutoff=99))
+        self.assertIsNone(extract_one("zzzzzzzz", choices, score_cutoff=99))
+
+
+class ExampleChoicesTestCase(unittest.TestCase):
+    """Tests for candidate pruning in ExampleChoices"""
+
+    def make_choices(self, sentences):
+        """Flatten sentences into choices with one example per sentence."""
+        return ExampleChoices(("Test", s, [i]) for i, s in enumerate(sentences))
+
+    def assert_same_match(self, choices, query, score_cutoff):
+        """Check that ExampleChoices.match agrees with a plain extractOne scan."""
+        self.assertEqual(
+            choices.match(query, score_cutoff=score_cutoff),
+            extract_one(query, choices.texts, score_cutoff=score_cutoff),
+        )
+
+    def test_prune_char_bitmaps(self):
+        """Verify the character bitmap bound keeps near misses that can match."""
+        query = "abcdefghij"
+        sentences = [
+            # 4 characters differ: exactly 80
+            "abcdefghxy",
+            # 6 characters differ: at most 70
+            "abcdefgxyz",
+            # Same characters, but a low score
+            "jihgfedcba",
+        ]
+        choices = self.make_choices(sentences)
+
+        self.assertEqual(choices.prune(query, 80).tolist(), [0, 2])
+        self.assertEqual(choices.prune(query, 80.1).tolist(), [2])
+        self.assertEqual(choices.prune(query, 70).tolist(), [0, 1, 2])
+
+        for score_cutoff in [0, 50, 70, 70.1, 80, 80.1, 100]:
+            self.assert_same_match(choices, query, score_cutoff)
+
+    def test_prune_length_window(self):
+        """Verify examples exactly at the length window edges are kept."""
+        # Cutoff 80 gives a window of 8-18 characters around 12
+        query = "abcdefghijkl"
+        sentences = [
+            "abcdefg",
+            "abcdefgh",
+            "abcdefghijklabcdef",
+            "abcdefghijklabcdefg",
+        ]
+        choices = self.make_choices(sentences)
+
+        self.assertEqual(choices.prune(query, 80).tolist(), [1, 2])
+
+        for score_cutoff in [0, 70, 80, 80.1]:
+            self.assert_same_match(choices, query, score_cutoff)
+
+        # Cutoff 200/3 gives a window of 5-20 characters around 10
+        query = "abcdefghij"
+        sentences = [
+            "abcd",
+            "abcde",
+            "abcdefghijabcdefghij",
+            "abcdefghijabcdefghija",
+        ]
+        choices = self.make_choices(sentences)
+
+        self.assertEqual(choices.prune(query, 200 / 3).tolist(), [1, 2])
+
+        for score_cutoff in [0, 60, 200 / 3, 67]:
+            self.assert_same_match(choices, query, score_cutoff)
+
+    def test_filter_ngrams(self):
+        """Verify the n-gram filter never drops the best match."""
+        sentences = make_sentences(NGRAM_MIN_CHOICES + 1000)
+        choices = self.make_choices(sentences)
+        self.assertTrue(choices.ngram_postings)
+
+        # Insert one character into some examples
+        rand = random.Random(1)
+        queries = []
+        for sentence in rand.sample(sentences, 20):
+            insert_index = rand.randint(0, len(sentence))
+            queries.append(sentence[:insert_index] + "x" + sentence[insert_index:])
+
+        for query in queries:
+            # Nothing can be filtered without a cutoff
+            self.assertIsNone(choices.filter_ngrams(query, 0))
+
+            # Filter has to drop something to be useful
+            filtered = choices.filter_ngrams(query, 90)
+            self.assertLess(len(filtered), len(choices))
+
+            for score_cutoff in [50, 80, 90, 95]:
+                candidates = choices.prune(query, score_cutoff)
+                candidates = choices.filter_ngrams(query, score_cutoff, candidates)
+
+                best = extract_one(query, choices.texts, score_cutoff=score_cutoff)
+                if best is not None:
+                    self.assertIn(best[1], candidates)